@@ -1,22 +1,49 @@
 #!/usr/bin/env python3
 import os
-import subprocess
 import asyncio
+import hashlib
+import time
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
+from pydantic import BaseModel
+
+try:
+    import orjson
+
+    class ORJSONResponse(JSONResponse):
+        def render(self, content):
+            return orjson.dumps(content)
+
+    DefaultResponse = ORJSONResponse
+except ImportError:
+    DefaultResponse = JSONResponse
 
 # =====================
 # CONFIG
 # =====================
 TV_IP = os.environ.get("TV_IP", "10.0.110.253")
 ADB_DEVICE = f"{TV_IP}:5555"
+ADB_DEVICE_BYTES = ADB_DEVICE.encode()
 SCRCPY_WEB_URL = "http://10.0.100.73:8000/"
 
 # =====================
 # APP
 # =====================
-app = FastAPI(title="Painel Android TV")
+@asynccontextmanager
+async def lifespan(app):
+    task = asyncio.create_task(adb_autoconnect())
+    yield
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    await shell.close()
+
+app = FastAPI(
+    title="Painel Android TV",
+    default_response_class=DefaultResponse,
+    lifespan=lifespan,
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -28,36 +55,162 @@ app.add_middleware(
 # =====================
 # ADB HELPER
 # =====================
-def adb(cmd, timeout=8):
-    try:
-        p = subprocess.run(
-            ["adb"] + cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            timeout=timeout,
+# Um comando adb por vez: evita forks concorrentes disputando o mesmo
+# device e "adb connect" duplicados. O timeout mata o processo e libera o lock.
+ADB_LOCK = asyncio.Lock()
+
+# stderr=False: quem chama não usa o stderr, então ele vai para DEVNULL
+# raw=True: stdout volta em bytes, sem decode
+async def adb(cmd, timeout=8, stderr=True, raw=False):
+    async with ADB_LOCK:
+        proc = None
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                "adb", *cmd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE if stderr else asyncio.subprocess.DEVNULL,
+            )
+            out, err = await asyncio.wait_for(proc.communicate(), timeout)
+            if proc.returncode != 0:
+                mark_offline()
+            return {
+                "stdout": out if raw else out.decode(errors="ignore"),
+                "stderr": err.decode(errors="ignore") if err else "",
+                "code": proc.returncode,
+            }
+        except Exception as e:
+            mark_offline()
+            return {"error": str(e) or type(e).__name__}
+        finally:
+            # também no timeout e no cancelamento (shutdown): não deixa adb órfão
+            if proc is not None and proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+
+# =====================
+# PERSISTENT SHELL
+# =====================
+# Um único "adb shell" aberto; os comandos são escritos no stdin e a saída
+# lida até o sentinela, evitando um fork + conexão adb a cada tecla.
+SENTINEL = "__END__"
+
+class AdbShell:
+    def __init__(self):
+        self.proc = None
+        self.lock = asyncio.Lock()
+
+    async def _spawn(self):
+        self.proc = await asyncio.create_subprocess_exec(
+            "adb", "-s", ADB_DEVICE, "shell",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
         )
-        return {
-            "stdout": p.stdout.decode(errors="ignore"),
-            "stderr": p.stderr.decode(errors="ignore"),
-            "code": p.returncode,
-        }
-    except Exception as e:
-        return {"error": str(e)}
+
+    async def _exchange(self, line):
+        self.proc.stdin.write(line)
+        await self.proc.stdin.drain()
+        await self.proc.stdout.readuntil(SENTINEL.encode())
+        return int(await self.proc.stdout.readline())
+
+    # line: comando já pronto em bytes, terminado pelo sentinela (shell_line)
+    async def run(self, line, timeout=8):
+        async with self.lock:
+            try:
+                if self.proc is None or self.proc.returncode is not None:
+                    await self._spawn()
+                code = await asyncio.wait_for(self._exchange(line), timeout)
+                return {"code": code}
+            except Exception as e:
+                await self._kill()
+                mark_offline()
+                return {"error": str(e) or type(e).__name__}
+
+    async def _kill(self):
+        proc, self.proc = self.proc, None
+        if proc is not None and proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+
+    async def close(self):
+        async with self.lock:
+            await self._kill()
+
+def shell_line(cmd):
+    return f"{cmd}; echo {SENTINEL}$?\n".encode()
+
+shell = AdbShell()
+
+# linhas de "input keyevent" pré-montadas: nada de formatar string por tecla
+KEYEVENT_CMDS = {k: shell_line(f"input keyevent {k}") for k in range(400)}
+
+# Mesma tecla repetida dentro da janela (clique duplo, botão "martelado")
+# reaproveita o resultado da anterior em vez de mandar outro keyevent.
+class KeyCoalescer:
+    WINDOW = 0.03
+
+    def __init__(self):
+        self.last_key = None
+        self.last_ts = 0.0
+        self.last_task = None
+
+    async def press(self, k):
+        now = time.monotonic()
+        if k != self.last_key or now - self.last_ts >= self.WINDOW:
+            self.last_key, self.last_ts = k, now
+            self.last_task = asyncio.ensure_future(shell.run(KEYEVENT_CMDS[k]))
+        # shield: cliente que desiste não cancela o keyevent no meio do shell
+        return await asyncio.shield(self.last_task)
+
+keys = KeyCoalescer()
 
 # =====================
 # AUTO RECONNECT
 # =====================
+# Nada de polling: qualquer falha do adb chama mark_offline(), que acorda
+# o loop abaixo; ele tenta "adb connect" com backoff até o device voltar.
+# kick_reconnect() (troca de IP) interrompe o backoff e tenta na hora.
+RECONNECT_BACKOFF = [1, 2, 5, 30]
+
+adb_online = False
+adb_lost = asyncio.Event()
+adb_lost.set()  # primeira conexão no startup
+adb_kick = asyncio.Event()
+
+def mark_offline():
+    global adb_online
+    adb_online = False
+    adb_lost.set()
+
+def kick_reconnect():
+    mark_offline()
+    adb_kick.set()
+
+def ensure_connected():
+    if not adb_online:
+        adb_lost.set()
+
 async def adb_autoconnect():
-    global ADB_DEVICE
+    global adb_online
     while True:
-        out = adb(["devices"])["stdout"]
-        if ADB_DEVICE not in out:
-            adb(["connect", ADB_DEVICE])
-        await asyncio.sleep(5)
-
-@app.on_event("startup")
-async def startup():
-    asyncio.create_task(adb_autoconnect())
+        await adb_lost.wait()
+        device, attempt = None, 0
+        while True:
+            if device != ADB_DEVICE:
+                device, attempt = ADB_DEVICE, 0
+            adb_kick.clear()
+            await adb(["connect", device], stderr=False)
+            out = (await adb(["devices"], stderr=False, raw=True)).get("stdout", b"")
+            if ADB_DEVICE_BYTES in out:
+                break
+            delay = RECONNECT_BACKOFF[min(attempt, len(RECONNECT_BACKOFF) - 1)]
+            attempt += 1
+            try:
+                await asyncio.wait_for(adb_kick.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+        adb_online = True
+        adb_lost.clear()
 
 # =====================
 # FRONTEND
@@ -280,37 +433,61 @@ resizeScrcpy();
 </html>
 """
 
+# HTML é estático depois do import: bytes e ETag calculados uma vez só
+HTML_BYTES = HTML.encode("utf-8")
+HTML_ETAG = f'"{hashlib.md5(HTML_BYTES).hexdigest()}"'
+
+# =====================
+# MODELS
+# =====================
+class KeyReq(BaseModel):
+    key: int
+
+class IPReq(BaseModel):
+    ip: str
+
 # =====================
 # ROUTES
 # =====================
 @app.get("/", response_class=HTMLResponse)
-def index():
-    return HTMLResponse(HTML)
+async def index(req: Request):
+    headers = {"ETag": HTML_ETAG, "Cache-Control": "public, max-age=60"}
+    if req.headers.get("if-none-match") == HTML_ETAG:
+        return Response(status_code=304, headers=headers)
+    return Response(content=HTML_BYTES, media_type="text/html", headers=headers)
 
 @app.post("/set_ip")
-async def set_ip(req: Request):
-    global TV_IP, ADB_DEVICE
-    body = await req.json()
-    TV_IP = body["ip"]
+async def set_ip(req: IPReq):
+    global TV_IP, ADB_DEVICE, ADB_DEVICE_BYTES
+    TV_IP = req.ip
     ADB_DEVICE = f"{TV_IP}:5555"
+    ADB_DEVICE_BYTES = ADB_DEVICE.encode()
+    await shell.close()
+    kick_reconnect()
     return {"device": ADB_DEVICE}
 
 @app.get("/connect")
-def connect():
-    return adb(["connect", ADB_DEVICE])
+async def connect():
+    ensure_connected()
+    return await adb(["connect", ADB_DEVICE])
 
 @app.get("/status")
-def status():
-    return JSONResponse({"devices": adb(["devices"])["stdout"]})
+async def status():
+    ensure_connected()
+    return {"devices": (await adb(["devices"], stderr=False)).get("stdout", "")}
 
 @app.post("/key")
-async def key(req: Request):
-    k = (await req.json()).get("key")
-    return adb(["-s", ADB_DEVICE, "shell", "input", "keyevent", str(k)])
+async def key(req: KeyReq):
+    k = req.key
+    if k not in KEYEVENT_CMDS:
+        return {"error": f"invalid key {k}"}
+    ensure_connected()
+    return await keys.press(k)
 
 @app.post("/reboot")
-def reboot():
-    return adb(["-s", ADB_DEVICE, "reboot"])
+async def reboot():
+    ensure_connected()
+    return await adb(["-s", ADB_DEVICE, "reboot"])
 
 # =====================
 # RUN